@@ -1,5 +1,6 @@
 import streamlit as st
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
+from postgrest import APIError
 from streamlit_folium import st_folium
 import folium
 import logging
@@ -7,21 +8,214 @@ from datetime import datetime, timedelta
 from twilio.rest import Client as TwilioClient
 from streamlit_autorefresh import st_autorefresh # Importé pour le rafraîchissement
 import bcrypt
+import httpx
+import random
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 # --- 0. Configuration de la Page ---
 st.set_page_config(page_title="Gestion Carburant Mali", layout="wide") # <-- Titre de l'onglet modifié
 logging.basicConfig(level=logging.INFO)
 
 # --- 1. Connexion à Supabase & Twilio ---
+DB_TIMEOUT_S = 5.0            # Timeout par requête HTTP vers Supabase
+DB_MAX_CONCURRENCY = 20       # Requêtes simultanées max (toutes sessions confondues)
+DB_MAX_RETRIES = 2            # Nouvelles tentatives pour les lectures uniquement
+DB_RETRY_BASE_S = 0.2         # Base du backoff exponentiel (avec jitter)
+DB_BREAKER_THRESHOLD = 5      # Échecs consécutifs avant ouverture du disjoncteur
+DB_BREAKER_COOLDOWN_S = 30.0  # Durée d'ouverture avant une requête d'essai
+DB_SNAPSHOT_MAX_PER_QUERY = 200 # Instantanés conservés par requête (LRU séparée par 'name')
+# Codes postgrest signalant une indisponibilité (et non une erreur applicative) :
+# timeout de requête, arrêt du serveur, ressources épuisées, connexion, erreurs PGRST0xx (503)
+DB_UNAVAILABLE_CODE_PREFIXES = ("57014", "57P", "53", "08", "PGRST0")
+
 @st.cache_resource
 def init_connection():
-    """Initialise la connexion à Supabase."""
+    """Initialise la connexion à Supabase (pool keep-alive + timeouts)."""
     url = st.secrets["supabase"]["url"]
     key = st.secrets["supabase"]["key"]
-    return create_client(url, key)
+    http_client = httpx.Client(
+        timeout=httpx.Timeout(DB_TIMEOUT_S, connect=3.0),
+        limits=httpx.Limits(
+            max_connections=DB_MAX_CONCURRENCY,
+            max_keepalive_connections=DB_MAX_CONCURRENCY,
+            keepalive_expiry=30.0
+        )
+    )
+    options = ClientOptions(postgrest_client_timeout=DB_TIMEOUT_S, httpx_client=http_client) # supabase >= 2.16
+    return create_client(url, key, options=options)
 
 supabase: Client = init_connection()
 
+
+class DatabaseUnavailable(Exception):
+    """Levée quand Supabase est injoignable (disjoncteur ouvert ou serveur saturé)."""
+
+
+def is_unavailable_error(error):
+    """Vrai pour les erreurs d'indisponibilité : réseau, timeout, HTTP 5xx."""
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, APIError):
+        code = str(error.code or "")
+        # Réponse non-JSON d'une passerelle (503, 504, 520...) : le code est le statut HTTP
+        if len(code) == 3 and code.isdigit():
+            return code.startswith("5")
+        return code.startswith(DB_UNAVAILABLE_CODE_PREFIXES)
+    return False
+
+
+class DataAccess:
+    """
+    Point d'accès unique à Supabase, partagé par toutes les sessions Streamlit.
+    Borne la concurrence, réessaie les lectures (backoff avec jitter), coupe
+    les appels via un disjoncteur quand Supabase ne répond plus, et renvoie
+    alors le dernier résultat valide connu pour les lectures.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._slots = threading.BoundedSemaphore(DB_MAX_CONCURRENCY)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        # Une LRU par requête : les lectures par station ne chassent pas les flux partagés
+        self._snapshots = defaultdict(OrderedDict)
+        self.stats = defaultdict(lambda: {"appels": 0, "echecs": 0, "retries": 0, "secours": 0, "duree_totale": 0.0})
+
+    def table(self, table_name):
+        return self.client.table(table_name)
+
+    def rpc(self, function_name, params):
+        return self.client.rpc(function_name, params)
+
+    def execute(self, build_query, name, key=None, read=False, fallback=True):
+        """
+        Exécute la requête construite par 'build_query' (callable sans argument).
+        Seules les lectures (read=True), idempotentes, sont réessayées et
+        peuvent retomber sur le dernier instantané valide. fallback=False
+        interdit ce repli (authentification, règles métier) : mieux vaut une
+        erreur qu'une décision prise sur des données périmées.
+        Les erreurs applicatives (contraintes, etc.) sont propagées telles quelles.
+        """
+        attempts = 1 + (DB_MAX_RETRIES if read else 0)
+        last_error = None
+
+        for attempt in range(attempts):
+            if attempt > 0:
+                self._count(name, "retries")
+                time.sleep(random.uniform(0, DB_RETRY_BASE_S * (2 ** attempt)))
+
+            if not self._breaker_allows():
+                last_error = DatabaseUnavailable(f"Disjoncteur ouvert, requête '{name}' non envoyée.")
+                break
+
+            if not self._slots.acquire(timeout=DB_TIMEOUT_S):
+                last_error = DatabaseUnavailable(f"Trop de requêtes simultanées, '{name}' abandonnée.")
+                continue
+
+            start = time.monotonic()
+            try:
+                query = build_query()
+                if hasattr(query, "retry"):
+                    # Les retries sont gérés ici : pas de retries postgrest (503/520) en plus
+                    query = query.retry(False)
+                response = query.execute()
+            except Exception as e:
+                if not is_unavailable_error(e):
+                    # Erreur applicative (contrainte, etc.) : Supabase a répondu, le
+                    # disjoncteur se referme (requête d'essai comprise), puis l'erreur est propagée
+                    self._record_success()
+                    raise
+                # Timeout, réseau ou 5xx : seule cette famille compte pour le disjoncteur
+                last_error = e
+                self._record_failure(name, e)
+                continue
+            finally:
+                self._slots.release()
+                self._record_duration(name, time.monotonic() - start)
+
+            self._record_success()
+            if read and fallback:
+                self._remember(name, key, response)
+            return response
+
+        if read and fallback:
+            with self._lock:
+                snapshot = self._snapshots[name].get(key)
+            if snapshot is not None:
+                self._count(name, "secours")
+                logging.warning(f"Supabase indisponible pour '{name}', utilisation du dernier instantané ({last_error}).")
+                return snapshot
+        raise last_error
+
+    @property
+    def breaker_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def get_stats(self):
+        """Copie des compteurs par requête (appels, échecs, retries, secours, durée)."""
+        with self._lock:
+            return {name: dict(values) for name, values in self.stats.items()}
+
+    # --- Mécanique interne ---
+
+    def _breaker_allows(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= DB_BREAKER_COOLDOWN_S:
+                # Demi-ouvert : une seule requête d'essai par période
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+    def _record_failure(self, name, error):
+        with self._lock:
+            self._failures += 1
+            self.stats[name]["echecs"] += 1
+            if self._failures >= DB_BREAKER_THRESHOLD:
+                if self._opened_at is None:
+                    logging.error(f"Disjoncteur Supabase ouvert après {self._failures} échecs (dernier: {error}).")
+                self._opened_at = time.monotonic()
+
+    def _record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info("Disjoncteur Supabase refermé.")
+            self._failures = 0
+            self._opened_at = None
+
+    def _record_duration(self, name, duration):
+        with self._lock:
+            self.stats[name]["appels"] += 1
+            self.stats[name]["duree_totale"] += duration
+        if duration > 1.0:
+            logging.warning(f"Requête lente '{name}': {duration:.2f}s")
+
+    def _remember(self, name, key, response):
+        with self._lock:
+            snapshots = self._snapshots[name]
+            snapshots[key] = response
+            snapshots.move_to_end(key)
+            while len(snapshots) > DB_SNAPSHOT_MAX_PER_QUERY:
+                snapshots.popitem(last=False)
+
+    def _count(self, name, counter):
+        with self._lock:
+            self.stats[name][counter] += 1
+
+
+@st.cache_resource
+def init_data_access():
+    """Initialise la couche d'accès aux données partagée."""
+    return DataAccess(supabase)
+
+db = init_data_access()
+
 # Cache pour le client Twilio
 @st.cache_resource
 def init_twilio_client():
@@ -37,48 +231,183 @@ def init_twilio_client():
 twilio_client = init_twilio_client()
 TWILIO_PHONE_NUMBER = st.secrets["twilio"].get("phone_number")
 
+SMS_WORKERS = 4 # Envois Twilio simultanés pour les SMS groupés
+
+@st.cache_resource
+def init_sms_executor():
+    """Pool de threads partagé pour les SMS groupés, hors des reruns Streamlit."""
+    return ThreadPoolExecutor(max_workers=SMS_WORKERS, thread_name_prefix="sms")
+
+sms_executor = init_sms_executor()
+
 # --- 2. Fonctions de la Base de Données ---
 
-# --- MODIFIÉ : Cache @st.cache_data(ttl=15) SUPPRIMÉ ---
+# --- Régions : chaque station porte une colonne 'region' (clé ci-dessous) ---
+REGIONS = {
+    "bamako": {"nom": "Bamako", "centre": [12.6392, -8.0029]},
+    "kayes": {"nom": "Kayes", "centre": [14.4469, -11.4456]},
+    "koulikoro": {"nom": "Koulikoro", "centre": [12.8627, -7.5599]},
+    "sikasso": {"nom": "Sikasso", "centre": [11.3176, -5.6665]},
+    "segou": {"nom": "Ségou", "centre": [13.4317, -6.2157]},
+    "mopti": {"nom": "Mopti", "centre": [14.4843, -4.1827]},
+    "tombouctou": {"nom": "Tombouctou", "centre": [16.7666, -3.0026]},
+    "gao": {"nom": "Gao", "centre": [16.2717, -0.0447]},
+}
+DEFAULT_REGION = "bamako" # Doit rester synchronisé avec get_stations_with_queue_counts (SQL)
+STATIONS_CACHE_TTL_S = 15 # Cache court, séparé par région (page client), vidé après chaque écriture
+
+# --- Contrôle d'admission : capacité projetée = stock / moyenne des litres servis ---
+ADMISSION_HISTORY_SIZE = 50          # Derniers services pris en compte dans la moyenne glissante
+DEFAULT_LITRES_PER_SERVICE = 20.0    # Moyenne utilisée tant qu'une station n'a pas d'historique
+SERVICE_AVERAGES_CACHE_TTL_S = 300   # La moyenne évolue lentement
+
+def nearest_region(latitude, longitude):
+    """Renvoie la clé de la région dont le centre est le plus proche des coordonnées."""
+    def distance(region):
+        lat, lon = REGIONS[region]["centre"]
+        return (lat - float(latitude)) ** 2 + (lon - float(longitude)) ** 2
+    return min(REGIONS, key=distance)
+
 def get_stations():
     """
-    Récupère la liste des stations ET LE COMPTAGE de leur file
-    en appelant la fonction SQL (RPC) de Supabase.
+    Récupère la liste de TOUTES les stations ET LE COMPTAGE de leur file
+    en appelant la fonction SQL (RPC) de Supabase. Réservé à l'admin.
     """
     try:
-        response = supabase.rpc('get_stations_with_queue_counts', {}).execute()
+        response = db.execute(
+            lambda: db.rpc('get_stations_with_queue_counts', {}),
+            name="get_stations", read=True
+        )
         return response.data
     except Exception as e:
         st.error(f"Erreur lors de la récupération des stations : {e}")
         return []
 
+@st.cache_data(ttl=STATIONS_CACHE_TTL_S, show_spinner=False)
+def _fetch_region_stations(region):
+    """Requête RPC filtrée sur une région, mise en cache séparément par région."""
+    # Filtre appliqué par la fonction SQL (p_region) ; les stations sans région
+    # (region NULL) sont renvoyées avec la région par défaut
+    response = db.execute(
+        lambda: db.rpc('get_stations_with_queue_counts', {'p_region': region}),
+        name="get_region_stations", key=region, read=True
+    )
+    return response.data
+
+def get_region_stations(region):
+    """Récupère les stations d'une seule région avec le comptage de leur file."""
+    try:
+        return _fetch_region_stations(region)
+    except Exception as e:
+        st.error(f"Erreur lors de la récupération des stations : {e}")
+        return []
+
+def get_station_by_username(username):
+    """Récupère la station associée à un identifiant pompiste (connexion)."""
+    try:
+        response = db.execute(
+            lambda: db.table("stations")
+                .select("station_id, nom_station, region, pompiste_password")
+                .eq("pompiste_username", username)
+                .limit(1),
+            name="station_pompiste", key=username, read=True, fallback=False # Jamais d'ancien hash
+        )
+        return response.data[0] if response.data else None
+    except Exception as e:
+        st.error(f"Erreur lors de la récupération de la station : {e}")
+        return None
+
+def get_station(station_id):
+    """Récupère le stock à jour d'une seule station (tableau de bord pompiste)."""
+    try:
+        response = db.execute(
+            lambda: db.table("stations")
+                .select("station_id, nom_station, stock_estime")
+                .eq("station_id", station_id)
+                .limit(1),
+            name="station", key=station_id, read=True
+        )
+        return response.data[0] if response.data else None
+    except Exception as e:
+        st.error(f"Erreur lors de la récupération de la station : {e}")
+        return None
+
+@st.cache_data(ttl=SERVICE_AVERAGES_CACHE_TTL_S, show_spinner=False)
+def _fetch_service_averages(station_ids):
+    """
+    Une seule requête RPC pour plusieurs stations : la fonction SQL applique
+    la fenêtre des ADMISSION_HISTORY_SIZE derniers services à chaque station.
+    """
+    response = db.execute(
+        lambda: db.rpc('get_service_averages', {
+            'p_station_ids': list(station_ids),
+            'p_history_size': ADMISSION_HISTORY_SIZE
+        }),
+        name="moyennes_services", key=station_ids, read=True
+    )
+    return {row['station_id']: float(row['litres_moyens']) for row in response.data}
+
+def get_service_averages(station_ids):
+    """
+    Moyenne glissante des litres servis par station (ADMISSION_HISTORY_SIZE
+    derniers services). Les stations sans historique ont DEFAULT_LITRES_PER_SERVICE.
+    """
+    station_ids = tuple(sorted(station_ids))
+    averages = {}
+    if station_ids:
+        try:
+            averages = _fetch_service_averages(station_ids)
+        except Exception as e:
+            logging.error(f"Erreur moyennes de service: {e}")
+    return {station_id: averages.get(station_id, DEFAULT_LITRES_PER_SERVICE) for station_id in station_ids}
+
+def projected_capacity(stock_estime, litres_per_service):
+    """Nombre de véhicules que le stock restant permet encore de servir."""
+    if not stock_estime or stock_estime <= 0:
+        return 0
+    return int(float(stock_estime) // max(float(litres_per_service), 1.0))
+
 def register_client(identifiant_vehicule, telephone_client, station_id):
     """Tente d'inscrire un client."""
     try:
         # Vérification 1: Règle des 2 jours
         date_limite = (datetime.now() - timedelta(days=2)).strftime("%Y-%m-%d")
         
-        response_history = supabase.table("historiqueservices") \
-            .select("service_id", count='exact', head=True) \
-            .eq("identifiant_vehicule", identifiant_vehicule) \
-            .gte("date_service", date_limite) \
-            .execute()
+        response_history = db.execute(
+            lambda: db.table("historiqueservices")
+                .select("service_id", count='exact', head=True)
+                .eq("identifiant_vehicule", identifiant_vehicule)
+                .gte("date_service", date_limite),
+            name="historique_vehicule", key=identifiant_vehicule, read=True, fallback=False
+        )
 
         if response_history.count > 0:
             return (False, "Erreur : Ce véhicule a déjà été servi dans les 2 derniers jours et ne peut pas se réinscrire.")
 
-        # Vérification 2: Inscription (gérée par la BDD avec la contrainte)
-        supabase.table("vehicules").upsert({
-            "identifiant_vehicule": identifiant_vehicule,
-            "telephone_client": telephone_client
-        }).execute()
-
-        supabase.table("fileattente").insert({
-            "station_id": station_id,
-            "identifiant_vehicule": identifiant_vehicule,
-            "statut": "en_attente"
-        }).execute()
-        
+        db.execute(
+            lambda: db.table("vehicules").upsert({
+                "identifiant_vehicule": identifiant_vehicule,
+                "telephone_client": telephone_client
+            }),
+            name="upsert_vehicule"
+        )
+
+        # Vérification 2: Capacité projetée + inscription, atomiques côté serveur (RPC)
+        # (la contrainte uq_vehicule_en_attente_partial reste gérée par la BDD)
+        response = db.execute(
+            lambda: db.rpc('register_in_queue', {
+                'p_station_id': station_id,
+                'p_identifiant_vehicule': identifiant_vehicule,
+                'p_history_size': ADMISSION_HISTORY_SIZE,
+                'p_default_litres': DEFAULT_LITRES_PER_SERVICE
+            }),
+            name="inscription_file"
+        )
+        resultat = response.data[0] if response.data else {}
+        if not resultat.get('admis'):
+            return (False, f"Erreur : La file de cette station est complète (stock estimé suffisant pour {resultat.get('capacite', 0)} véhicule(s)). Choisissez une autre station.")
+
+        _fetch_region_stations.clear() # File et places changées : flux des stations à relire
         return (True, "Inscription à la file d'attente réussie !")
 
     except Exception as e:
@@ -92,11 +421,13 @@ def register_client(identifiant_vehicule, telephone_client, station_id):
 def get_client_status(identifiant_vehicule):
     """Récupère le statut d'un client ET LE STOCK DE LA STATION."""
     try:
-        response = supabase.table("fileattente") \
-            .select("station_id, heure_inscription, statut, stations(nom_station, stock_estime)") \
-            .eq("identifiant_vehicule", identifiant_vehicule) \
-            .in_("statut", ["en_attente", "notifie"]) \
-            .execute()
+        response = db.execute(
+            lambda: db.table("fileattente")
+                .select("station_id, heure_inscription, statut, stations(nom_station, stock_estime)")
+                .eq("identifiant_vehicule", identifiant_vehicule)
+                .in_("statut", ["en_attente", "notifie"]),
+            name="statut_client", read=True, fallback=False # Un client servi ne doit pas se voir encore 'en_attente'
+        )
         
         if not response.data:
             return None, "Vous n'êtes actuellement dans aucune file d'attente active."
@@ -113,14 +444,16 @@ def get_client_status(identifiant_vehicule):
             stock_estime = user_entry['stations'].get('stock_estime', 0)
 
         # Compter les gens avant
-        response_list = supabase.table("fileattente") \
-            .select("file_id") \
-            .eq("station_id", station_id) \
-            .in_("statut", ["en_attente", "notifie"]) \
-            .lt("heure_inscription", user_time) \
-            .execute()
-
-        position = len(response_list.data)
+        response_list = db.execute(
+            lambda: db.table("fileattente")
+                .select("file_id", count='exact', head=True)
+                .eq("station_id", station_id)
+                .in_("statut", ["en_attente", "notifie"])
+                .lt("heure_inscription", user_time),
+            name="position_client", read=True, fallback=False
+        )
+
+        position = response_list.count or 0
         
         return {"station": station_name, "statut": user_status, "position": position, "stock": stock_estime}, None
 
@@ -129,6 +462,15 @@ def get_client_status(identifiant_vehicule):
         return None, "Une erreur est survenue en consultant votre statut."
 
 
+def format_phone_number(to_number):
+    """Nettoie un numéro et force le préfixe +223 si manquant (format E.164)."""
+    formatted_to_number = str(to_number).strip().replace(" ", "") # Nettoyer
+    
+    if not formatted_to_number.startswith('+'):
+        logging.info(f"Numéro {formatted_to_number} n'est pas au format E.164, ajout du préfixe +223.")
+        formatted_to_number = f"+223{formatted_to_number}"
+    return formatted_to_number
+
 def send_sms(to_number, body_message):
     """Envoie un SMS via Twilio, en forçant le préfixe +223 si manquant."""
     if not twilio_client or not TWILIO_PHONE_NUMBER:
@@ -137,11 +479,7 @@ def send_sms(to_number, body_message):
         return False
         
     try:
-        formatted_to_number = str(to_number).strip().replace(" ", "") # Nettoyer
-        
-        if not formatted_to_number.startswith('+'):
-            logging.info(f"Numéro {formatted_to_number} n'est pas au format E.164, ajout du préfixe +223.")
-            formatted_to_number = f"+223{formatted_to_number}"
+        formatted_to_number = format_phone_number(to_number)
 
         message = twilio_client.messages.create(
             body=body_message,
@@ -155,27 +493,67 @@ def send_sms(to_number, body_message):
         st.error(f"Échec de l'envoi du SMS à {to_number}. (Erreur Twilio: {e})")
         return False
 
+def _send_sms_in_background(formatted_to_number, body_message):
+    """Envoi unitaire exécuté dans le pool SMS (aucun appel st.* hors du rerun)."""
+    try:
+        twilio_client.messages.create(
+            body=body_message,
+            from_=TWILIO_PHONE_NUMBER,
+            to=formatted_to_number
+        )
+        return True
+    except Exception as e:
+        logging.error(f"Erreur envoi SMS groupé à {formatted_to_number}: {e}")
+        return False
+
+def send_bulk_sms(to_numbers, body_message):
+    """
+    Met en file l'envoi du même SMS à plusieurs numéros (dédoublonnés) dans le
+    pool SMS partagé, et rend la main immédiatement : le rerun du pompiste ou
+    de l'admin n'attend pas les appels Twilio. Un seul bilan est journalisé à
+    la fin du lot. Renvoie le nombre de SMS mis en file.
+    """
+    if not twilio_client or not TWILIO_PHONE_NUMBER:
+        logging.warning("Configuration Twilio manquante. SMS groupé non envoyé.")
+        return 0
+
+    formatted_numbers = {format_phone_number(n) for n in to_numbers if n}
+    if not formatted_numbers:
+        return 0
+
+    bilan = {"restants": len(formatted_numbers), "envoyes": 0}
+    bilan_lock = threading.Lock()
+
+    def on_done(future):
+        with bilan_lock:
+            bilan["restants"] -= 1
+            bilan["envoyes"] += 1 if future.result() else 0
+            if bilan["restants"] == 0:
+                logging.info(f"SMS groupé: {bilan['envoyes']}/{len(formatted_numbers)} envoyé(s).")
+
+    for formatted_to_number in formatted_numbers:
+        sms_executor.submit(_send_sms_in_background, formatted_to_number, body_message).add_done_callback(on_done)
+    return len(formatted_numbers)
+
 # --- Fonctions Pompiste ---
 
 # --- MODIFIÉ : Cache @st.cache_data(ttl=15) SUPPRIMÉ ---
 def get_queue_for_station(station_id):
     """Récupère les files 'notifie' (physique) et 'en_attente' (virtuelle) pour une station."""
     try:
-        response_notifie = supabase.table("fileattente") \
-            .select("file_id, identifiant_vehicule, heure_inscription") \
-            .eq("station_id", station_id) \
-            .eq("statut", "notifie") \
-            .order("heure_inscription", desc=False) \
-            .execute()
-
-        response_en_attente = supabase.table("fileattente") \
-            .select("file_id, identifiant_vehicule, heure_inscription") \
-            .eq("station_id", station_id) \
-            .eq("statut", "en_attente") \
-            .order("heure_inscription", desc=False) \
-            .execute()
-            
-        return response_notifie.data, response_en_attente.data
+        # Une seule requête pour les deux files, séparées ensuite côté client
+        response = db.execute(
+            lambda: db.table("fileattente")
+                .select("file_id, identifiant_vehicule, heure_inscription, statut")
+                .eq("station_id", station_id)
+                .in_("statut", ["notifie", "en_attente"])
+                .order("heure_inscription", desc=False),
+            name="files_station", key=station_id, read=True
+        )
+
+        file_notifie = [c for c in response.data if c['statut'] == "notifie"]
+        file_en_attente = [c for c in response.data if c['statut'] == "en_attente"]
+        return file_notifie, file_en_attente
     except Exception as e:
         st.error(f"Erreur récupération files: {e}")
         return [], []
@@ -187,11 +565,13 @@ def update_physical_queue(station_id, station_name, num_to_call, max_queue_size=
     """
     try:
         # 1. Compter la file physique actuelle
-        response_count = supabase.table("fileattente") \
-            .select("count", head=True) \
-            .eq("station_id", station_id) \
-            .eq("statut", "notifie") \
-            .execute()
+        response_count = db.execute(
+            lambda: db.table("fileattente")
+                .select("file_id", count='exact', head=True)
+                .eq("station_id", station_id)
+                .eq("statut", "notifie"),
+            name="taille_file_physique", read=True, fallback=False # Décide des appels : jamais périmé
+        )
         
         current_queue_size = response_count.count if response_count.count is not None else 0
         
@@ -203,23 +583,27 @@ def update_physical_queue(station_id, station_name, num_to_call, max_queue_size=
 
         if actual_num_to_call > 0:
             # 3. ...trouver les N prochains clients en attente
-            response_next = supabase.table("fileattente") \
-                .select("file_id, identifiant_vehicule, vehicules(telephone_client)") \
-                .eq("station_id", station_id) \
-                .eq("statut", "en_attente") \
-                .order("heure_inscription", desc=False) \
-                .limit(actual_num_to_call) \
-                .execute()
+            response_next = db.execute(
+                lambda: db.table("fileattente")
+                    .select("file_id, identifiant_vehicule, vehicules(telephone_client)")
+                    .eq("station_id", station_id)
+                    .eq("statut", "en_attente")
+                    .order("heure_inscription", desc=False)
+                    .limit(actual_num_to_call),
+                name="prochains_clients", read=True, fallback=False
+            )
             
             if response_next.data:
                 clients_a_notifier = response_next.data
                 client_ids = [client['file_id'] for client in clients_a_notifier]
                 
                 # 4. Changer leur statut à 'notifie'
-                supabase.table("fileattente") \
-                    .update({"statut": "notifie"}) \
-                    .in_("file_id", client_ids) \
-                    .execute()
+                db.execute(
+                    lambda: db.table("fileattente")
+                        .update({"statut": "notifie"})
+                        .in_("file_id", client_ids),
+                    name="notifier_clients"
+                )
                 
                 sms_envoyes = 0
                 for client in clients_a_notifier:
@@ -244,49 +628,126 @@ def update_physical_queue(station_id, station_name, num_to_call, max_queue_size=
     except Exception as e:
         logging.error(f"Erreur lors de la mise à jour de la file physique: {e}")
 
-def mark_as_served(file_id, identifiant_vehicule, station_id, litres_vendus):
-    """Passe un client au statut 'servi', ajoute à l'historique ET DÉCRÉMENTE LE STOCK."""
+def mark_as_served(file_id, identifiant_vehicule, station_id, station_name, litres_vendus):
+    """
+    Passe un client au statut 'servi', ajoute à l'historique ET DÉCRÉMENTE LE STOCK.
+    Si la station est à sec, toute sa file est annulée en une fois.
+    """
     try:
         # 1. Mettre à jour le statut
-        supabase.table("fileattente") \
-            .update({"statut": "servi"}) \
-            .eq("file_id", file_id) \
-            .execute()
+        db.execute(
+            lambda: db.table("fileattente")
+                .update({"statut": "servi"})
+                .eq("file_id", file_id),
+            name="marquer_servi"
+        )
         
         # 2. Ajouter à l'historique (AVEC les litres)
-        supabase.table("historiqueservices").insert({
-            "identifiant_vehicule": identifiant_vehicule,
-            "station_id": station_id,
-            "litres_vendus": litres_vendus # <-- Ajouté
-        }).execute()
+        db.execute(
+            lambda: db.table("historiqueservices").insert({
+                "identifiant_vehicule": identifiant_vehicule,
+                "station_id": station_id,
+                "litres_vendus": litres_vendus # <-- Ajouté
+            }),
+            name="insert_historique"
+        )
         
         # 3. Appeler la fonction RPC pour décrémenter le stock
-        supabase.rpc('decrement_station_stock', {
-            'p_station_id': station_id,
-            'p_litres_sold': litres_vendus
-        }).execute()
+        db.execute(
+            lambda: db.rpc('decrement_station_stock', {
+                'p_station_id': station_id,
+                'p_litres_sold': litres_vendus
+            }),
+            name="decrement_station_stock"
+        )
         
         logging.info(f"Client {identifiant_vehicule} marqué 'servi'. {litres_vendus}L déduits.")
+        _fetch_region_stations.clear() # Stock et file changés
+
+        # 4. Station à sec : annuler toute la file restante
+        try:
+            response_stock = db.execute(
+                lambda: db.table("stations")
+                    .select("stock_estime")
+                    .eq("station_id", station_id)
+                    .limit(1),
+                name="stock_station", key=station_id
+            )
+            if response_stock.data and response_stock.data[0].get('stock_estime', 0) <= 0:
+                nb_annules, sms_en_file = cancel_station_queue(station_id, station_name)
+                if nb_annules:
+                    st.warning(f"Stock épuisé, annulation automatique : {cancel_summary(nb_annules, sms_en_file)}")
+        except Exception as e:
+            # Le service est enregistré : l'échec de la vérification du stock n'est pas bloquant
+            logging.error(f"Erreur vérification stock après service: {e}")
         return True
     except Exception as e:
         st.error(f"Erreur lors de la mise à jour 'servi': {e}")
         return False
 
-def cancel_queue_entry(file_id):
-    """Appelle la fonction RPC pour annuler un client."""
+def cancel_station_queue(station_id, station_name):
+    """
+    Annule toutes les inscriptions actives (en_attente et notifie) d'une
+    station à sec, puis met en file un SMS groupé (envoyé en arrière-plan)
+    pour prévenir les clients. La RPC verrouille la station et n'annule rien
+    si son stock est repassé au-dessus de 0.
+    Renvoie (inscriptions annulées, SMS mis en file).
+    """
     try:
-        supabase.rpc('cancel_queue_entry', { 'p_file_id': file_id }).execute()
-        logging.info(f"Client {file_id} marqué comme 'annule'.")
-        return True
+        response = db.execute(
+            lambda: db.rpc('cancel_station_queue', {'p_station_id': station_id}),
+            name="annuler_file_station"
+        )
+        annules = response.data or []
+        logging.info(f"Station {station_id}: {len(annules)} inscription(s) marquée(s) 'annule'.")
+        if not annules:
+            return 0, 0
+        _fetch_region_stations.clear()
+
+        message = f"Gestion Essence: La {station_name} n'a plus de carburant. Votre inscription est annulée, vous pouvez vous inscrire dans une autre station."
+        sms_en_file = send_bulk_sms([entry['telephone_client'] for entry in annules], message)
+        return len(annules), sms_en_file
     except Exception as e:
-        st.error(f"Erreur lors de l'annulation: {e}")
-        return False
+        st.error(f"Erreur lors de l'annulation de la file: {e}")
+        return 0, 0
+
+def cancel_summary(nb_annules, sms_en_file):
+    """Message de bilan d'une annulation groupée, fidèle aux SMS réellement mis en file."""
+    if not nb_annules:
+        return "Aucune inscription annulée (stock réapprovisionné ou file déjà vide)."
+    if not sms_en_file:
+        return f"{nb_annules} client(s) annulé(s). Aucun SMS envoyé (SMS non configuré ou numéros introuvables)."
+    return f"{nb_annules} client(s) annulé(s). {sms_en_file} SMS en cours d'envoi."
 
 
 # --- 3. Définition des Pages ---
 
-def client_page(stations_data):
-    """Affiche la page principale pour les clients."""
+def select_region():
+    """
+    Sélecteur de région de la page client. La région initiale vient de l'URL
+    (?region=kayes), sinon de la position (?lat=..&lon=..), sinon Bamako.
+    """
+    region_keys = list(REGIONS.keys())
+    default_region = st.query_params.get("region")
+    if default_region not in REGIONS:
+        try:
+            default_region = nearest_region(st.query_params["lat"], st.query_params["lon"])
+        except (KeyError, ValueError):
+            default_region = DEFAULT_REGION
+
+    region = st.selectbox(
+        "Région :",
+        options=region_keys,
+        index=region_keys.index(default_region),
+        format_func=lambda r: REGIONS[r]["nom"],
+        key="region_select"
+    )
+    if st.query_params.get("region") != region:
+        st.query_params["region"] = region
+    return region
+
+def client_page():
+    """Affiche la page principale pour les clients (stations d'une seule région)."""
     
     # --- Auto-refresh (300 000ms = 5 minutes) ---
     st_autorefresh(interval=300000, key="client_refresh")
@@ -306,8 +767,10 @@ def client_page(stations_data):
 
     with tab1:
         st.header("Localisez une station")
+        region = select_region()
+        stations_data = get_region_stations(region)
         if stations_data:
-            map_center = [12.6392, -8.0029]
+            map_center = REGIONS[region]["centre"]
             m = folium.Map(location=map_center, zoom_start=12)
             for station in stations_data:
                 couleur = "green" if station['carburant_disponible'] else "red"
@@ -327,21 +790,34 @@ def client_page(stations_data):
                 ).add_to(m)
             st_folium(m, width=725, height=400) # Hauteur réduite pour mobile
         else:
-            st.warning("Aucune station n'a été trouvée dans la base de données.")
+            st.warning(f"Aucune station n'a été trouvée dans la région de {REGIONS[region]['nom']}.")
 
         st.header("🎟️ S'inscrire à une file d'attente")
         if stations_data:
             station_options = {}
+            stations_completes = []
+            moyennes = get_service_averages([s['station_id'] for s in stations_data])
             for s in stations_data:
                 # Vérifie le stock en plus de la disponibilité
                 if s['carburant_disponible'] and s.get('stock_estime', 0) > 0:
                     queue_count = s.get('queue_count', 0)
                     stock_estime = s.get('stock_estime', 0)
-                    display_name = f"{s['nom_station']} (File: {queue_count} | Stock: {stock_estime} L)"
+                    # Contrôle d'admission : la file ne doit pas dépasser ce que le stock permet de servir
+                    capacity = projected_capacity(stock_estime, moyennes[s['station_id']])
+                    if queue_count >= capacity:
+                        stations_completes.append(s['nom_station'])
+                        continue
+                    display_name = f"{s['nom_station']} (File: {queue_count} | Places: {capacity - queue_count} | Stock: {stock_estime} L)"
                     station_options[display_name] = s['station_id']
 
+            if stations_completes:
+                st.info(f"File complète (stock insuffisant pour de nouveaux inscrits) : {', '.join(stations_completes)}")
+
             if not station_options:
-                st.warning("Aucune station n'a de carburant disponible pour le moment (stock > 0).")
+                if stations_completes:
+                    st.warning("Toutes les stations avec du carburant ont une file complète. Réessayez plus tard ou choisissez une autre région.")
+                else:
+                    st.warning("Aucune station n'a de carburant disponible pour le moment (stock > 0).")
             else:
                 with st.form("inscription_form"):
                     selected_station_name = st.selectbox(
@@ -403,13 +879,17 @@ def client_page(stations_data):
                     st.session_state.status_check_result = {"info": status_info, "error": error}
                     st.rerun() 
 
-def pompiste_page(stations_data):
+def pompiste_page():
     """Affiche la page de gestion pour le pompiste."""
     
     # --- Auto-refresh (120 000ms = 2 minutes) ---
     st_autorefresh(interval=120000, key="pompiste_refresh")
     
     st.title("🧑‍💼 Interface Pompiste")
+
+    if "toast_message" in st.session_state:
+        st.toast(st.session_state.toast_message, icon="✅", duration=8000)
+        del st.session_state.toast_message # L'effacer après affichage
     
     if 'pompiste_logged_in' not in st.session_state:
         st.session_state['pompiste_logged_in'] = False
@@ -429,21 +909,19 @@ def pompiste_page(stations_data):
                 return
 
             found_station = None
-            for station in stations_data:
-                if station.get('pompiste_username') == username:
-                    stored_hash_str = station.get('pompiste_password')
-                    if stored_hash_str:
-                        try:
-                            stored_hash_bytes = stored_hash_str.encode('utf-8')
-                            entered_password_bytes = password.encode('utf-8')
-                            
-                            if bcrypt.checkpw(entered_password_bytes, stored_hash_bytes):
-                                found_station = station
-                                break
-                        except Exception as e:
-                            logging.error(f"Erreur Bcrypt: {e}")
-                            st.error("Erreur lors de la vérification du mot de passe.")
-                    
+            station = get_station_by_username(username)
+            if station:
+                stored_hash_str = station.get('pompiste_password')
+                if stored_hash_str:
+                    try:
+                        stored_hash_bytes = stored_hash_str.encode('utf-8')
+                        entered_password_bytes = password.encode('utf-8')
+                        
+                        if bcrypt.checkpw(entered_password_bytes, stored_hash_bytes):
+                            found_station = station
+                    except Exception as e:
+                        logging.error(f"Erreur Bcrypt: {e}")
+                        st.error("Erreur lors de la vérification du mot de passe.")
             
             if found_station:
                 st.session_state['pompiste_logged_in'] = True
@@ -471,13 +949,14 @@ def pompiste_page(stations_data):
     st.header("Tableau de Bord")
     
     # Récupérer les données une seule fois
-    current_station_data = next((s for s in stations_data if s['station_id'] == selected_station_id), None)
-    stock = current_station_data.get('stock_estime', 0) if current_station_data else 0
+    current_station_data = get_station(selected_station_id)
+    # None = stock inconnu (lecture impossible) : ni service ni annulation groupée
+    stock = current_station_data.get('stock_estime', 0) if current_station_data else None
     file_physique, file_virtuelle = get_queue_for_station(selected_station_id)
     
     # Afficher les métriques
     col_met1, col_met2, col_met3 = st.columns(3)
-    col_met1.metric("Stock Restant", f"{int(stock)} L")
+    col_met1.metric("Stock Restant", f"{int(stock)} L" if stock is not None else "Inconnu")
     col_met2.metric("File Physique", f"{len(file_physique)} / 10")
     col_met3.metric("File Virtuelle", f"{len(file_virtuelle)}")
     st.divider()
@@ -504,6 +983,15 @@ def pompiste_page(stations_data):
                 update_physical_queue(selected_station_id, selected_station_name, num_to_call)
             # get_queue_for_station.clear() # <-- Ligne supprimée
             st.rerun()
+
+    # --- Stock épuisé : annulation groupée de toute la file ---
+    if stock is not None and stock <= 0 and (file_physique or file_virtuelle):
+        st.warning(f"Stock épuisé : {len(file_physique) + len(file_virtuelle)} client(s) encore inscrit(s).")
+        if st.button("Annuler toute la file (Stock Épuisé)", key="cancel_all_btn", type="primary"):
+            with st.spinner("Annulation de la file et envoi des SMS..."):
+                nb_annules, sms_en_file = cancel_station_queue(selected_station_id, selected_station_name)
+            st.session_state.toast_message = cancel_summary(nb_annules, sms_en_file)
+            st.rerun()
     
     st.divider()
 
@@ -521,7 +1009,9 @@ def pompiste_page(stations_data):
                     st.markdown(f"**Client: {client['identifiant_vehicule']}**")
                     
                     # --- Logique conditionnelle basée sur le stock ---
-                    if stock > 0:
+                    if stock is None:
+                        st.info("Stock momentanément indisponible. Rafraîchissez avant de servir.")
+                    elif stock > 0:
                         # Si le stock est OK, afficher le formulaire de service
                         litres_vendus = st.number_input(
                             "Litres vendus:", 
@@ -546,6 +1036,7 @@ def pompiste_page(stations_data):
                                         client['file_id'], 
                                         client['identifiant_vehicule'], 
                                         selected_station_id,
+                                        selected_station_name,
                                         litres_to_deduct 
                                     )
                                 
@@ -557,16 +1048,8 @@ def pompiste_page(stations_data):
                                     # get_stations.clear() # <-- Ligne supprimée
                                     st.rerun()
                     else:
-                        # Si le stock est à 0, afficher le bouton d'annulation
+                        # Si le stock est à 0, l'annulation se fait pour toute la file (voir Actions)
                         st.warning(f"Stock épuisé ({stock}L). Vous ne pouvez plus servir.")
-                        if st.button("Annuler (Stock Épuisé)", key=f"cancel_btn_{key_base}", type="primary"):
-                            with st.spinner("Annulation du client..."):
-                                success = cancel_queue_entry(client['file_id'])
-                                if success:
-                                    st.success(f"Client {client['identifiant_vehicule']} annulé et libéré.")
-                                    # get_queue_for_station.clear() # <-- Ligne supprimée
-                                    # get_stations.clear() # <-- Ligne supprimée
-                                    st.rerun()
                     
                     st.divider()
 
@@ -581,7 +1064,7 @@ def pompiste_page(stations_data):
                     st.text(client['identifiant_vehicule'])
 
 # --- PAGE ADMIN ---
-def admin_page(stations_data):
+def admin_page():
     """Affiche la page d'administration pour gérer les utilisateurs pompistes."""
     st.title("👑 Interface Administrateur")
 
@@ -602,9 +1085,33 @@ def admin_page(stations_data):
         return
 
     st.success("Accès Administrateur autorisé.")
+
+    if "toast_message" in st.session_state:
+        st.toast(st.session_state.toast_message, icon="✅", duration=8000)
+        del st.session_state.toast_message # L'effacer après affichage
+
+    # --- Instrumentation de la couche d'accès aux données ---
+    with st.expander("📊 Statistiques Supabase (depuis le démarrage du serveur)"):
+        st.write(f"Disjoncteur : {'🔴 ouvert' if db.breaker_open else '🟢 fermé'}")
+        stats = db.get_stats()
+        if not stats:
+            st.info("Aucune requête enregistrée pour le moment.")
+        else:
+            st.dataframe([
+                {
+                    "requête": name,
+                    "appels": values["appels"],
+                    "échecs": values["echecs"],
+                    "retries": values["retries"],
+                    "secours (instantané)": values["secours"],
+                    "durée moy. (ms)": round(1000 * values["duree_totale"] / values["appels"], 1) if values["appels"] else 0.0,
+                }
+                for name, values in sorted(stats.items())
+            ])
     st.header("Gérer les comptes Pompiste")
-    st.info("Créez ou mettez à jour le nom d'utilisateur, le mot de passe et le stock pour une station.")
+    st.info("Créez ou mettez à jour le nom d'utilisateur, le mot de passe, la région et le stock pour une station.")
 
+    stations_data = get_stations()
     if not stations_data:
         st.warning("Aucune station à configurer.")
         return
@@ -621,6 +1128,14 @@ def admin_page(stations_data):
         station_id = selected_station['station_id']
         current_username = selected_station.get('pompiste_username', "")
         current_stock = selected_station.get('stock_estime', 0)
+        current_region = selected_station.get('region')
+        if current_region not in REGIONS:
+            # Station pas encore rattachée : proposer la région la plus proche
+            try:
+                current_region = nearest_region(selected_station['latitude'], selected_station['longitude'])
+            except (KeyError, TypeError, ValueError):
+                current_region = DEFAULT_REGION
+        region_keys = list(REGIONS.keys())
         
         st.subheader(f"Modification de : {selected_station_name}")
         
@@ -635,6 +1150,13 @@ def admin_page(stations_data):
                 type="password", 
                 key=f"pass_{station_id}"
             )
+            new_region = st.selectbox(
+                "Région",
+                options=region_keys,
+                index=region_keys.index(current_region),
+                format_func=lambda r: REGIONS[r]["nom"],
+                key=f"region_{station_id}"
+            )
             new_stock = st.number_input(
                 "Stock estimé (Litres)", 
                 min_value=0, 
@@ -656,6 +1178,9 @@ def admin_page(stations_data):
                             "stock_estime": new_stock,
                             "carburant_disponible": (new_stock > 0) # Vrai si stock > 0
                         }
+                        if new_region != selected_station.get('region'):
+                            # Région écrite seulement si elle change (ou si la station n'en avait pas)
+                            update_data["region"] = new_region
                         
                         if new_password:
                             st.spinner("Hachage du mot de passe...")
@@ -664,12 +1189,20 @@ def admin_page(stations_data):
                             update_data["pompiste_password"] = hashed_password_bytes.decode('utf-8')
                             logging.info(f"Nouveau hachage créé pour {new_username}")
 
-                        supabase.table("stations") \
-                            .update(update_data) \
-                            .eq("station_id", station_id) \
-                            .execute()
+                        db.execute(
+                            lambda: db.table("stations")
+                                .update(update_data)
+                                .eq("station_id", station_id),
+                            name="update_station"
+                        )
                         
+                        _fetch_region_stations.clear() # Stock / région visibles tout de suite côté client
                         st.success(f"Informations pour {selected_station_name} mises à jour !")
+                        if new_stock <= 0:
+                            # Station mise à sec par l'admin : libérer toute sa file
+                            nb_annules, sms_en_file = cancel_station_queue(station_id, selected_station_name)
+                            if nb_annules:
+                                st.session_state.toast_message = cancel_summary(nb_annules, sms_en_file)
                         # get_stations.clear() # <-- Ligne supprimée
                         st.rerun()
 
@@ -718,16 +1251,15 @@ def main():
         """, unsafe_allow_html=True)
     # --- FIN DU CSS ---
 
-    stations = get_stations()
-    
+    # Chaque page ne charge que ses propres données (région, station, ou tout pour l'admin)
     page = st.query_params.get("page", "client")
 
     if page == "pompiste":
-        pompiste_page(stations)
+        pompiste_page()
     elif page == "admin": 
-        admin_page(stations)
+        admin_page()
     else:
-        client_page(stations)
+        client_page()
 
 if __name__ == "__main__":
     main()
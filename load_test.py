@@ -0,0 +1,643 @@
+"""
+Test de charge des pages Streamlit (client, pompiste, admin).
+
+Chaque session simulée est une instance AppTest de app.py. Supabase est
+remplacé par un faux backend en mémoire (latence réseau simulée), et Twilio
+n'est pas configuré : aucun appel externe n'est fait.
+
+Pour chaque niveau de concurrence, le script lance autant de sessions en
+parallèle (inscriptions + consultations de statut, cycles appel/service
+pompiste, mise à jour admin) et affiche :
+  - les latences p50 / p95 / p99 d'un rerun,
+  - la mémoire retenue par session (tracemalloc),
+  - le nombre d'appels backend par seconde,
+  - les inscriptions refusées (file complète) et annulées (station à sec).
+Une partie des stations démarre presque à sec (--low-stock-ratio) afin que le
+contrôle d'admission et l'annulation groupée soient exercés sous charge.
+
+Le harnais repose sur des internes non publics de Streamlit (écrit pour la
+1.66) : check_streamlit_internals() arrête le script avec un message clair
+s'ils ont changé dans la version installée.
+
+Usage :
+    python load_test.py --levels 10,50,100,200 --latency-ms 20
+    python load_test.py --levels 50 --no-memory   # latences sans le surcoût de tracemalloc
+"""
+import argparse
+import itertools
+import logging
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import bcrypt
+import streamlit as st
+
+# Version de Streamlit pour laquelle concurrent_apptest() a été écrit : il
+# s'appuie sur des internes non publics (Runtime, ScriptCache, config de test)
+TESTED_STREAMLIT_VERSION = "1.66"
+STREAMLIT_INTERNALS_ERROR = (
+    f"load_test.py a été écrit pour Streamlit {TESTED_STREAMLIT_VERSION}.x et utilise des internes "
+    f"de streamlit.testing qui ont changé dans la version installée ({st.__version__}) : {{}}. "
+    f"Installez streamlit=={TESTED_STREAMLIT_VERSION}.* ou adaptez concurrent_apptest()."
+)
+
+try:
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.runtime.secrets import Secrets
+    from streamlit.testing.v1 import AppTest
+    from streamlit.testing.v1.util import patch_config_options
+except ImportError as e:
+    raise SystemExit(STREAMLIT_INTERNALS_ERROR.format(e))
+
+APP_PATH = "app.py"
+ADMIN_PASSWORD = "admin-load-test"
+POMPISTE_PASSWORD = "pompiste-load-test"
+MIN_LEVEL = 3 # 1 admin + au moins 1 pompiste + au moins 1 client
+LOW_STOCK_LITRES = 60.0 # Stations "presque à sec" : 3 véhicules à la moyenne par défaut (20 L)
+SERVICE_LITRES = 30.0 # Litres servis par le pompiste : une station à 60 L est à sec en 2 services
+POMPISTE_WAIT_S = 0.5 # Attente du pompiste quand sa file est vide
+POMPISTE_MAX_WAITS = 10
+SECRETS = {
+    "supabase": {"url": "https://load-test.supabase.co", "key": "load-test"},
+    "twilio": {"account_sid": "AC" + "0" * 32, "auth_token": "load-test"}, # Pas de phone_number : aucun SMS
+    "admin": {"password": ADMIN_PASSWORD},
+}
+
+# Régions simulées (clés de REGIONS dans app.py) et leur centre approximatif
+SEED_REGIONS = {
+    "bamako": (12.6392, -8.0029),
+    "kayes": (14.4469, -11.4456),
+    "sikasso": (11.3176, -5.6665),
+    "segou": (13.4317, -6.2157),
+    "mopti": (14.4843, -4.1827),
+}
+
+PRIMARY_KEYS = {
+    "stations": "station_id",
+    "vehicules": "identifiant_vehicule",
+    "fileattente": "file_id",
+    "historiqueservices": "service_id",
+}
+
+
+# --- 1. Faux backend Supabase ---
+
+def _split_columns(columns):
+    """Découpe 'a, b, rel(c, d)' en ['a', 'b', 'rel(c, d)'] (virgules de premier niveau)."""
+    parts, depth, current = [], 0, ""
+    for char in columns:
+        if char == "," and depth == 0:
+            parts.append(current.strip())
+            current = ""
+            continue
+        depth += char == "("
+        depth -= char == ")"
+        current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+class FakeQuery:
+    """Sous-ensemble du constructeur de requêtes postgrest utilisé par app.py."""
+
+    def __init__(self, backend, table_name=None, rpc=None):
+        self.backend = backend
+        self.table_name = table_name
+        self.rpc_call = rpc
+        self.action = "select"
+        self.columns = "*"
+        self.count_mode = None
+        self.head = False
+        self.payload = None
+        self.filters = []
+        self.order_by = None
+        self.limit_n = None
+
+    def select(self, columns="*", count=None, head=False):
+        self.columns, self.count_mode, self.head = columns, count, head
+        return self
+
+    def insert(self, payload):
+        self.action, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload):
+        self.action, self.payload = "upsert", payload
+        return self
+
+    def update(self, payload):
+        self.action, self.payload = "update", payload
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] >= value)
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] < value)
+        return self
+
+    def in_(self, column, values):
+        values = list(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def order(self, column, desc=False):
+        self.order_by = (column, desc)
+        return self
+
+    def limit(self, n):
+        self.limit_n = n
+        return self
+
+    def execute(self):
+        return self.backend.execute(self)
+
+
+class FakeSupabase:
+    """Base en mémoire, thread-safe, avec une latence réseau simulée par appel."""
+
+    def __init__(self, latency_s=0.0):
+        self.latency_s = latency_s
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.calls = 0
+        self.refused = 0
+        self.rpcs = {
+            "get_stations_with_queue_counts": self._rpc_stations_with_queue_counts,
+            "decrement_station_stock": self._rpc_decrement_station_stock,
+            "get_service_averages": self._rpc_service_averages,
+            "register_in_queue": self._rpc_register_in_queue,
+            "cancel_station_queue": self._rpc_cancel_station_queue,
+        }
+        self.tables = {name: [] for name in PRIMARY_KEYS}
+
+    def seed(self, stations_per_region, low_stock_ratio=0.0):
+        """
+        Réinitialise la base avec 'stations_per_region' stations par région. Une
+        part 'low_stock_ratio' de chaque région démarre à LOW_STOCK_LITRES, pour
+        exercer le contrôle d'admission et l'annulation groupée sous charge.
+        """
+        low_stock_per_region = round(low_stock_ratio * stations_per_region)
+        password_hash = bcrypt.hashpw(POMPISTE_PASSWORD.encode("utf-8"), bcrypt.gensalt(rounds=4)).decode("utf-8")
+        with self._lock:
+            self.tables = {name: [] for name in PRIMARY_KEYS}
+            station_id = 0
+            for region, (lat, lon) in SEED_REGIONS.items():
+                for i in range(stations_per_region):
+                    station_id += 1
+                    self.tables["stations"].append({
+                        "station_id": station_id,
+                        "nom_station": f"Station {region.capitalize()} {i + 1}",
+                        "region": region,
+                        "latitude": lat + random.uniform(-0.05, 0.05),
+                        "longitude": lon + random.uniform(-0.05, 0.05),
+                        "carburant_disponible": True,
+                        "stock_estime": LOW_STOCK_LITRES if i < low_stock_per_region else 1_000_000,
+                        "pompiste_username": f"pompiste{station_id}",
+                        "pompiste_password": password_hash,
+                    })
+            self.calls = 0
+            self.refused = 0
+
+    def table(self, table_name):
+        return FakeQuery(self, table_name=table_name)
+
+    def rpc(self, function_name, params):
+        return FakeQuery(self, rpc=(function_name, params))
+
+    def execute(self, query):
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        with self._lock:
+            self.calls += 1
+            if query.rpc_call:
+                function_name, params = query.rpc_call
+                rows = self.rpcs[function_name](params)
+                return self._respond(query, rows if isinstance(rows, list) else [])
+            handler = getattr(self, f"_{query.action}")
+            return handler(query)
+
+    # --- Actions ---
+
+    def _select(self, query):
+        return self._respond(query, self.tables[query.table_name])
+
+    def _respond(self, query, rows):
+        rows = [row for row in rows if all(f(row) for f in query.filters)]
+        if query.order_by:
+            column, desc = query.order_by
+            rows = sorted(rows, key=lambda row: row.get(column), reverse=desc)
+        count = len(rows) if query.count_mode else None
+        if query.limit_n is not None:
+            rows = rows[:query.limit_n]
+        if query.head:
+            return SimpleNamespace(data=[], count=count)
+        return SimpleNamespace(data=[self._project(row, query.columns) for row in rows], count=count)
+
+    def _project(self, row, columns):
+        if columns == "*":
+            return dict(row)
+        projected = {}
+        for column in _split_columns(columns):
+            if "(" in column:
+                relation, sub_columns = column[:-1].split("(", 1)
+                relation = relation.strip()
+                key = PRIMARY_KEYS[relation]
+                target = next((r for r in self.tables[relation] if r[key] == row.get(key)), None)
+                projected[relation] = self._project(target, sub_columns) if target else None
+            else:
+                projected[column] = row.get(column)
+        return projected
+
+    def _insert(self, query):
+        rows = query.payload if isinstance(query.payload, list) else [query.payload]
+        inserted = []
+        for payload in rows:
+            row = dict(payload)
+            if query.table_name == "fileattente":
+                self._check_unique_active_entry(row["identifiant_vehicule"])
+                # Microsecondes croissantes : ordre d'inscription stable
+                row.setdefault("heure_inscription", (datetime.now() + timedelta(microseconds=next(self._ids))).isoformat())
+            if query.table_name == "historiqueservices":
+                row.setdefault("date_service", datetime.now().isoformat())
+            row.setdefault(PRIMARY_KEYS[query.table_name], next(self._ids))
+            self.tables[query.table_name].append(row)
+            inserted.append(dict(row))
+        return SimpleNamespace(data=inserted, count=None)
+
+    def _upsert(self, query):
+        key = PRIMARY_KEYS[query.table_name]
+        existing = next((r for r in self.tables[query.table_name] if r.get(key) == query.payload.get(key)), None)
+        if existing is None:
+            return self._insert(query)
+        existing.update(query.payload)
+        return SimpleNamespace(data=[dict(existing)], count=None)
+
+    def _update(self, query):
+        updated = []
+        for row in self.tables[query.table_name]:
+            if all(f(row) for f in query.filters):
+                row.update(query.payload)
+                updated.append(dict(row))
+        return SimpleNamespace(data=updated, count=None)
+
+    def _check_unique_active_entry(self, identifiant_vehicule):
+        for row in self.tables["fileattente"]:
+            if row["identifiant_vehicule"] == identifiant_vehicule and row["statut"] in ("en_attente", "notifie"):
+                raise Exception('duplicate key value violates unique constraint "uq_vehicule_en_attente_partial"')
+
+    # --- Fonctions RPC ---
+
+    def _rpc_stations_with_queue_counts(self, params):
+        counts = {}
+        for row in self.tables["fileattente"]:
+            if row["statut"] in ("en_attente", "notifie"):
+                counts[row["station_id"]] = counts.get(row["station_id"], 0) + 1
+        region = params.get("p_region")
+        return [
+            dict(s, queue_count=counts.get(s["station_id"], 0)) for s in self.tables["stations"]
+            if region is None or s["region"] == region or (region == "bamako" and s["region"] is None)
+        ]
+
+    def _rpc_service_averages(self, params):
+        services = sorted(self.tables["historiqueservices"], key=lambda h: h["date_service"], reverse=True)
+        litres_by_station = {}
+        for service in services:
+            litres = litres_by_station.setdefault(service["station_id"], [])
+            if service["station_id"] in params["p_station_ids"] and len(litres) < params["p_history_size"]:
+                litres.append(float(service["litres_vendus"]))
+        return [
+            {"station_id": station_id, "litres_moyens": sum(litres) / len(litres)}
+            for station_id, litres in litres_by_station.items() if litres
+        ]
+
+    def _rpc_register_in_queue(self, params):
+        # Exécuté sous self._lock : atomique, comme la fonction SQL avec FOR UPDATE
+        station = next(s for s in self.tables["stations"] if s["station_id"] == params["p_station_id"])
+        averages = self._rpc_service_averages({"p_station_ids": [station["station_id"]], "p_history_size": params["p_history_size"]})
+        average = averages[0]["litres_moyens"] if averages else params["p_default_litres"]
+        capacity = int(station["stock_estime"] // max(average, 1)) if station["stock_estime"] > 0 else 0
+        queue_size = sum(
+            1 for row in self.tables["fileattente"]
+            if row["station_id"] == station["station_id"] and row["statut"] in ("en_attente", "notifie")
+        )
+        admitted = queue_size < capacity
+        if admitted:
+            self._insert(SimpleNamespace(table_name="fileattente", payload={
+                "station_id": station["station_id"],
+                "identifiant_vehicule": params["p_identifiant_vehicule"],
+                "statut": "en_attente",
+            }))
+        else:
+            self.refused += 1
+        return [{"admis": admitted, "capacite": capacity}]
+
+    def _rpc_decrement_station_stock(self, params):
+        for station in self.tables["stations"]:
+            if station["station_id"] == params["p_station_id"]:
+                station["stock_estime"] = max(0, station["stock_estime"] - params["p_litres_sold"])
+                station["carburant_disponible"] = station["stock_estime"] > 0
+
+    def _rpc_cancel_station_queue(self, params):
+        # Exécuté sous self._lock, comme la fonction SQL avec FOR UPDATE
+        station = next(s for s in self.tables["stations"] if s["station_id"] == params["p_station_id"])
+        if station["stock_estime"] > 0:
+            return []
+        phones = {v["identifiant_vehicule"]: v.get("telephone_client") for v in self.tables["vehicules"]}
+        cancelled = []
+        for row in self.tables["fileattente"]:
+            if row["station_id"] == station["station_id"] and row["statut"] in ("en_attente", "notifie"):
+                row["statut"] = "annule"
+                cancelled.append({
+                    "file_id": row["file_id"],
+                    "identifiant_vehicule": row["identifiant_vehicule"],
+                    "telephone_client": phones.get(row["identifiant_vehicule"]),
+                })
+        return cancelled
+
+
+# --- 2. Sessions simulées ---
+
+class Recorder:
+    """Collecte (thread-safe) les durées de rerun et les erreurs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = []
+        self.errors = 0
+
+    def run(self, at):
+        start = time.perf_counter()
+        at.run()
+        duration = time.perf_counter() - start
+        with self._lock:
+            self.durations.append(duration)
+            self.errors += len(at.exception)
+        return at
+
+    def fail(self):
+        with self._lock:
+            self.errors += 1
+
+
+def _by_label(widgets, label):
+    return next(w for w in widgets if w.label == label)
+
+
+def check_streamlit_internals():
+    """Échoue tôt, avec un message clair, si les internes patchés ont bougé."""
+    import streamlit.testing.v1.app_test as app_test_module
+    import streamlit.testing.v1.local_script_runner as local_script_runner_module
+
+    missing = [
+        name for name, present in [
+            ("Runtime._instance", hasattr(Runtime, "_instance")),
+            ("Runtime.instance", hasattr(Runtime, "instance")),
+            ("Runtime.exists", hasattr(Runtime, "exists")),
+            ("app_test.ScriptCache", hasattr(app_test_module, "ScriptCache")),
+            ("local_script_runner.ScriptCache", hasattr(local_script_runner_module, "ScriptCache")),
+            ("Secrets._secrets", "_secrets" in vars(Secrets())),
+        ] if not present
+    ]
+    if missing:
+        raise SystemExit(STREAMLIT_INTERNALS_ERROR.format("introuvables : " + ", ".join(missing)))
+    if not st.__version__.startswith(TESTED_STREAMLIT_VERSION + "."):
+        print(f"Attention : Streamlit {st.__version__} installé, harnais testé avec {TESTED_STREAMLIT_VERSION}.x.")
+
+
+@contextmanager
+def concurrent_apptest():
+    """
+    AppTest n'est pas prévu pour des runs simultanés : chaque run installe puis
+    efface des objets globaux (Runtime, st.secrets, options de config) et
+    recompile le script. On les fige ici pour toute la campagne, afin que les
+    sessions tournent en parallèle dans des threads comme sur un vrai serveur
+    Streamlit (qui partage lui aussi un seul cache de bytecode).
+    """
+    last_runtime = {}
+    script_cache = ScriptCache()
+
+    def instance(cls):
+        if cls._instance is not None:
+            last_runtime["runtime"] = cls._instance
+            return cls._instance
+        # Un autre thread a terminé son run et remis _instance à None
+        return last_runtime["runtime"]
+
+    def exists(cls):
+        return cls._instance is not None or "runtime" in last_runtime
+
+    saved_secrets = st.secrets
+    st.secrets = Secrets()
+    st.secrets._secrets = SECRETS
+    try:
+        with patch_config_options({"global.appTest": True}), \
+                mock.patch.object(Runtime, "instance", classmethod(instance)), \
+                mock.patch.object(Runtime, "exists", classmethod(exists)), \
+                mock.patch("streamlit.testing.v1.app_test.ScriptCache", return_value=script_cache), \
+                mock.patch("streamlit.testing.v1.local_script_runner.ScriptCache", return_value=script_cache):
+            # Run de chauffe séquentiel : enregistre le Runtime et remplit les caches de ressources
+            new_app("client").run()
+            yield
+    finally:
+        st.secrets = saved_secrets
+
+
+def new_app(page, region=None, timeout=60):
+    # Pas de at.secrets : les secrets globaux sont installés par concurrent_apptest()
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.query_params["page"] = page
+    if region:
+        at.query_params["region"] = region
+    return at
+
+
+def client_session(recorder, plate, region, polls, target_station=None):
+    """
+    Inscription dans une station de la région, puis 'polls' consultations de statut.
+    Si 'target_station' est encore proposée (non complète), elle est choisie.
+    """
+    at = recorder.run(new_app("client", region))
+    station_select = _by_label(at.selectbox, "Choisissez votre station:")
+    targets = [o for o in station_select.options if target_station and o.startswith(target_station + " ")]
+    station_select.select(targets[0] if targets else random.choice(station_select.options))
+    _by_label(at.text_input, "N° de plaque ou de cadre").input(plate)
+    _by_label(at.text_input, "Votre N° de téléphone (Ex: 74749730)").input("70000000")
+    _by_label(at.button, "S'inscrire").click()
+    recorder.run(at)
+
+    for _ in range(polls):
+        at.text_input(key="status_check_input").input(plate)
+        _by_label(at.button, "Vérifier mon statut").click()
+        recorder.run(at)
+    return at
+
+
+def pompiste_session(recorder, station_id, cycles):
+    """
+    Connexion, puis 'cycles' services (appel d'un client puis service). Tant que
+    la file est vide, le pompiste patiente (hors mesure) dans la limite de
+    POMPISTE_MAX_WAITS appels infructueux.
+    """
+    at = recorder.run(new_app("pompiste"))
+    _by_label(at.text_input, "Nom d'utilisateur").input(f"pompiste{station_id}")
+    _by_label(at.text_input, "Mot de passe").input(POMPISTE_PASSWORD)
+    _by_label(at.button, "Se connecter").click()
+    recorder.run(at)
+
+    served = waits = 0
+    while served < cycles and waits < POMPISTE_MAX_WAITS:
+        _by_label(at.button, "Appeler 1 client(s) de la file virtuelle").click()
+        recorder.run(at)
+        serve_buttons = [b for b in at.button if b.key and b.key.startswith("servi_btn_")]
+        if not serve_buttons:
+            waits += 1
+            time.sleep(POMPISTE_WAIT_S)
+            continue
+        file_id = serve_buttons[0].key[len("servi_btn_"):]
+        at.number_input(key=f"litres_{file_id}").set_value(SERVICE_LITRES)
+        serve_buttons[0].click()
+        recorder.run(at)
+        served += 1
+    return at
+
+
+def admin_session(recorder):
+    """Authentification admin puis une mise à jour de station."""
+    at = recorder.run(new_app("admin"))
+    at.text_input(key="admin_pass").input(ADMIN_PASSWORD)
+    recorder.run(at)
+    _by_label(at.button, "Mettre à jour").click()
+    recorder.run(at)
+    return at
+
+
+def _guarded(recorder, session, *args):
+    try:
+        return session(recorder, *args)
+    except Exception as e:
+        # Widget introuvable ou timeout : la session est comptée en erreur
+        logging.warning(f"Session {session.__name__}({', '.join(map(repr, args))}) en erreur : {type(e).__name__}: {e}")
+        recorder.fail()
+        return None
+
+
+# --- 3. Campagne de charge ---
+
+def run_level(backend, sessions, polls, cycles, stations_per_region, low_stock_ratio, measure_memory):
+    """Lance 'sessions' sessions simultanées et renvoie les métriques du niveau."""
+    backend.seed(stations_per_region, low_stock_ratio)
+    st.cache_data.clear()
+    recorder = Recorder()
+
+    # Pompistes affectés en priorité aux stations presque à sec : elles se vident sous charge
+    stations = sorted(backend.tables["stations"], key=lambda s: s["stock_estime"])
+    station_ids = [s["station_id"] for s in stations]
+    num_pompistes = min(len(station_ids), max(1, sessions // 10), sessions - 2)
+    num_clients = sessions - num_pompistes - 1
+    regions = list(SEED_REGIONS)
+    # Un client sur deux vise la station presque à sec de sa région : la course à la dernière place
+    low_stock_names = {}
+    for s in stations:
+        if s["stock_estime"] == LOW_STOCK_LITRES:
+            low_stock_names.setdefault(s["region"], s["nom_station"])
+
+    jobs = []
+    for i in range(num_clients):
+        region = regions[i % len(regions)]
+        target = low_stock_names.get(region) if i % 2 == 0 else None
+        jobs.append((client_session, f"LT{sessions}-{i}", region, polls, target))
+    jobs += [(pompiste_session, station_ids[i], cycles) for i in range(num_pompistes)]
+    jobs.append((admin_session,))
+    random.shuffle(jobs)
+
+    if measure_memory:
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+    calls_before = backend.calls
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        apps = list(pool.map(lambda job: _guarded(recorder, *job), jobs))
+    elapsed = time.perf_counter() - start
+    calls = backend.calls - calls_before
+
+    memory_per_session = None
+    if measure_memory:
+        # Les AppTest (et leur session_state) sont encore référencés par 'apps'
+        memory_per_session = (tracemalloc.get_traced_memory()[0] - memory_before) / len(jobs)
+        tracemalloc.stop()
+    del apps
+
+    durations = sorted(recorder.durations)
+    centiles = statistics.quantiles(durations, n=100) if len(durations) > 1 else durations * 99
+    return {
+        "sessions": len(jobs),
+        "reruns": len(durations),
+        "p50_ms": centiles[49] * 1000,
+        "p95_ms": centiles[94] * 1000,
+        "p99_ms": centiles[98] * 1000,
+        "memoire_kib": memory_per_session / 1024 if memory_per_session is not None else None,
+        "appels_par_s": calls / elapsed if elapsed else 0.0,
+        "refus": backend.refused,
+        "annules": sum(1 for row in backend.tables["fileattente"] if row["statut"] == "annule"),
+        "erreurs": recorder.errors,
+    }
+
+
+def print_report(results):
+    header = (f"{'sessions':>8} {'reruns':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'mém/session KiB':>16} "
+              f"{'appels/s':>9} {'refus':>6} {'annulés':>8} {'erreurs':>8}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        memory = f"{r['memoire_kib']:.0f}" if r["memoire_kib"] is not None else "-"
+        print(f"{r['sessions']:>8} {r['reruns']:>7} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} {r['p99_ms']:>9.1f} "
+              f"{memory:>16} {r['appels_par_s']:>9.1f} {r['refus']:>6} {r['annules']:>8} {r['erreurs']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge des pages Streamlit contre un faux backend.")
+    parser.add_argument("--levels", default="10,50,100,200", help="Niveaux de concurrence (sessions simultanées)")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Latence simulée par appel backend")
+    parser.add_argument("--polls", type=int, default=3, help="Consultations de statut par client")
+    parser.add_argument("--cycles", type=int, default=3, help="Cycles appel/service par pompiste")
+    parser.add_argument("--stations-per-region", type=int, default=4, help="Stations par région simulée")
+    parser.add_argument("--low-stock-ratio", type=float, default=0.25,
+                        help=f"Part des stations démarrant à {LOW_STOCK_LITRES:.0f} L (admission + annulation groupée)")
+    parser.add_argument("--no-memory", action="store_true", help="Désactive tracemalloc (qui ralentit les reruns)")
+    args = parser.parse_args()
+    levels = [int(n) for n in args.levels.split(",")]
+    if min(levels) < MIN_LEVEL:
+        parser.error(f"chaque niveau doit compter au moins {MIN_LEVEL} sessions (1 admin, 1 pompiste, 1 client)")
+    check_streamlit_internals()
+
+    backend = FakeSupabase(latency_s=args.latency_ms / 1000)
+    results = []
+    backend.seed(args.stations_per_region)
+    with mock.patch("supabase.create_client", return_value=backend), concurrent_apptest():
+        for level in levels:
+            result = run_level(backend, level, args.polls, args.cycles, args.stations_per_region,
+                               args.low_stock_ratio, not args.no_memory)
+            results.append(result)
+            print(f"Niveau {level} terminé : {result['reruns']} reruns, {result['erreurs']} erreur(s).")
+    print()
+    print_report(results)
+
+
+if __name__ == "__main__":
+    main()
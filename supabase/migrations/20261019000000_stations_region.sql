@@ -0,0 +1,74 @@
+-- Partitionnement régional des stations (app.py : REGIONS, get_region_stations).
+-- Les centres ci-dessous doivent rester synchronisés avec REGIONS dans app.py.
+
+alter table public.stations add column if not exists region text;
+
+-- Rattache chaque station existante à la région dont le centre est le plus proche
+-- (même règle que nearest_region() dans le formulaire admin).
+update public.stations s
+set region = (
+    select r.region
+    from (values
+        ('bamako',     12.6392,  -8.0029),
+        ('kayes',      14.4469, -11.4456),
+        ('koulikoro',  12.8627,  -7.5599),
+        ('sikasso',    11.3176,  -5.6665),
+        ('segou',      13.4317,  -6.2157),
+        ('mopti',      14.4843,  -4.1827),
+        ('tombouctou', 16.7666,  -3.0026),
+        ('gao',        16.2717,  -0.0447)
+    ) as r(region, latitude, longitude)
+    order by power(r.latitude - s.latitude, 2) + power(r.longitude - s.longitude, 2)
+    limit 1
+)
+where s.region is null
+  and s.latitude is not null
+  and s.longitude is not null;
+
+-- Stations sans coordonnées : région par défaut (DEFAULT_REGION)
+update public.stations set region = 'bamako' where region is null;
+
+create index if not exists idx_stations_region on public.stations (region);
+
+-- Flux des stations avec le comptage de leur file, filtré par région côté SQL.
+-- p_region NULL (page admin) : toutes les stations. p_region = 'bamako'
+-- (DEFAULT_REGION) inclut aussi les stations pas encore rattachées (region NULL).
+-- L'ancienne version sans argument est supprimée : avec les deux signatures,
+-- un appel sans paramètre serait ambigu pour PostgREST.
+drop function if exists public.get_stations_with_queue_counts();
+
+create or replace function public.get_stations_with_queue_counts(p_region text default null)
+returns table (
+    station_id bigint,
+    nom_station text,
+    region text,
+    latitude double precision,
+    longitude double precision,
+    carburant_disponible boolean,
+    stock_estime numeric,
+    pompiste_username text,
+    queue_count bigint
+)
+language sql
+stable
+as $$
+    select s.station_id::bigint,
+           s.nom_station::text,
+           s.region,
+           s.latitude::double precision,
+           s.longitude::double precision,
+           s.carburant_disponible,
+           s.stock_estime::numeric,
+           s.pompiste_username::text,
+           (
+               select count(*)
+               from public.fileattente f
+               where f.station_id = s.station_id
+                 and f.statut in ('en_attente', 'notifie')
+           ) as queue_count
+    from public.stations s
+    where p_region is null
+       or s.region = p_region
+       or (p_region = 'bamako' and s.region is null)
+    order by s.nom_station;
+$$;
@@ -0,0 +1,24 @@
+-- Moyenne glissante des litres servis, calculée séparément pour CHAQUE station
+-- (p_history_size derniers services de chacune). Utilisée par la page client
+-- (app.py : get_service_averages) et par le contrôle d'admission.
+
+create or replace function public.get_service_averages(
+    p_station_ids bigint[],
+    p_history_size integer default 50
+)
+returns table (station_id bigint, litres_moyens numeric)
+language sql
+stable
+as $$
+    select h.station_id::bigint, avg(h.litres_vendus)::numeric
+    from (
+        select hs.station_id,
+               hs.litres_vendus,
+               row_number() over (partition by hs.station_id order by hs.date_service desc) as rang
+        from public.historiqueservices hs
+        where hs.station_id = any(p_station_ids)
+          and hs.litres_vendus > 0
+    ) h
+    where h.rang <= p_history_size
+    group by h.station_id;
+$$;
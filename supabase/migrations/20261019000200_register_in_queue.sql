@@ -0,0 +1,54 @@
+-- Inscription avec contrôle d'admission atomique (app.py : register_client).
+-- Le verrou FOR UPDATE sur la station sérialise les inscriptions simultanées
+-- d'une même station : la file ne peut pas dépasser la capacité projetée,
+-- même pendant un rush. Capacité = stock / moyenne glissante des litres servis
+-- (get_service_averages), même règle que projected_capacity() côté app.
+
+create or replace function public.register_in_queue(
+    p_station_id bigint,
+    p_identifiant_vehicule text,
+    p_history_size integer default 50,
+    p_default_litres numeric default 20
+)
+returns table (admis boolean, capacite integer)
+language plpgsql
+as $$
+declare
+    v_stock numeric;
+    v_moyenne numeric;
+    v_file integer;
+begin
+    select s.stock_estime into v_stock
+    from public.stations s
+    where s.station_id = p_station_id
+    for update;
+
+    if not found then
+        raise exception 'Station % introuvable', p_station_id;
+    end if;
+
+    select coalesce(
+        (select a.litres_moyens from public.get_service_averages(array[p_station_id], p_history_size) a),
+        p_default_litres
+    ) into v_moyenne;
+
+    capacite := case
+        when coalesce(v_stock, 0) <= 0 then 0
+        else floor(v_stock / greatest(v_moyenne, 1))::integer
+    end;
+
+    select count(*) into v_file
+    from public.fileattente f
+    where f.station_id = p_station_id
+      and f.statut in ('en_attente', 'notifie');
+
+    admis := v_file < capacite;
+    if admis then
+        -- La contrainte uq_vehicule_en_attente_partial reste appliquée ici
+        insert into public.fileattente (station_id, identifiant_vehicule, statut)
+        values (p_station_id, p_identifiant_vehicule, 'en_attente');
+    end if;
+
+    return next;
+end;
+$$;
@@ -0,0 +1,39 @@
+-- Annulation groupée de la file d'une station à sec (app.py : cancel_station_queue).
+-- Le verrou FOR UPDATE sur la station (le même que register_in_queue) sérialise
+-- l'annulation avec les inscriptions et le réapprovisionnement : rien n'est
+-- annulé si le stock est repassé au-dessus de 0 entre l'affichage et le clic.
+-- Renvoie les inscriptions annulées avec le numéro à prévenir par SMS.
+
+create or replace function public.cancel_station_queue(p_station_id bigint)
+returns table (file_id bigint, identifiant_vehicule text, telephone_client text)
+language plpgsql
+as $$
+declare
+    v_stock numeric;
+begin
+    select s.stock_estime into v_stock
+    from public.stations s
+    where s.station_id = p_station_id
+    for update;
+
+    if not found then
+        raise exception 'Station % introuvable', p_station_id;
+    end if;
+
+    if coalesce(v_stock, 0) > 0 then
+        return;
+    end if;
+
+    return query
+    with annules as (
+        update public.fileattente f
+        set statut = 'annule'
+        where f.station_id = p_station_id
+          and f.statut in ('en_attente', 'notifie')
+        returning f.file_id, f.identifiant_vehicule
+    )
+    select a.file_id::bigint, a.identifiant_vehicule::text, v.telephone_client::text
+    from annules a
+    left join public.vehicules v on v.identifiant_vehicule = a.identifiant_vehicule;
+end;
+$$;